@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from __future__ import absolute_import, unicode_literals
 import json
 import os
 import csv
@@ -1,15 +1,81 @@
-from __future__ import absolute_import, unicode_literals
 import os
+import time
 import subprocess
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from . import log
 
-def download(url, outpath):
-    r = requests.get(url, stream=True)
+def download(url, outpath, chunk_size=128, timeout=None):
+    r = requests.get(url, stream=True, timeout=timeout)
+    r.raise_for_status()
     with open(outpath, 'wb') as fd:
-        for chunk in r.iter_content(chunk_size=128):
+        for chunk in r.iter_content(chunk_size=chunk_size):
             fd.write(chunk)
-    
+
+RANGE_RETRIES = 3
+TIMEOUT = (30, 120)
+
+class RangeNotSupported(Exception):
+    pass
+
+class ShortRead(Exception):
+    pass
+
+def download_ranges(url, outpath, workers=8, chunk_size=64*1024*1024, retries=RANGE_RETRIES, timeout=TIMEOUT):
+    # Fetch byte ranges in parallel into a preallocated file; falls back to
+    # a single stream if the server does not support HEAD or Range requests.
+    try:
+        r = requests.head(url, allow_redirects=True, timeout=timeout)
+        r.raise_for_status()
+    except requests.RequestException as e:
+        log.debug('HEAD request failed, using single stream: %s'%e)
+        return download(url, outpath, chunk_size=1024*1024, timeout=timeout)
+    url = r.url
+    size = int(r.headers.get('Content-Length') or 0)
+    if size <= 0 or r.headers.get('Accept-Ranges') != 'bytes':
+        log.debug('range requests not supported; using single stream')
+        return download(url, outpath, chunk_size=1024*1024, timeout=timeout)
+    fd = os.open(outpath, os.O_WRONLY | os.O_CREAT, 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            os.posix_fallocate(fd, 0, size)
+        else:
+            os.ftruncate(fd, size)
+        def fetch_range(start, end):
+            resp = requests.get(url, headers={'Range': 'bytes=%s-%s'%(start, end)}, stream=True, timeout=timeout)
+            try:
+                resp.raise_for_status()
+                if resp.status_code != 206:
+                    raise RangeNotSupported(url)
+                offset = start
+                for chunk in resp.iter_content(chunk_size=1024*1024):
+                    os.pwrite(fd, chunk, offset)
+                    offset += len(chunk)
+                if offset != end + 1:
+                    raise ShortRead('short read for range %s-%s: %s'%(start, end, url))
+            finally:
+                resp.close()
+        def fetch(start):
+            end = min(start + chunk_size, size) - 1
+            for attempt in range(retries):
+                try:
+                    return fetch_range(start, end)
+                except (requests.RequestException, ShortRead) as e:
+                    if attempt == retries - 1:
+                        raise
+                    log.warning('retrying range %s-%s: %s'%(start, end, e))
+                    time.sleep(2**attempt)
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(fetch, range(0, size, chunk_size)))
+    except RangeNotSupported:
+        log.debug('server ignored Range header; using single stream')
+        os.close(fd)
+        fd = None
+        return download(url, outpath, chunk_size=1024*1024, timeout=timeout)
+    finally:
+        if fd is not None:
+            os.close(fd)
+
 def download_gzip(url, outpath):
     with open(outpath, 'wb') as f:
         ps1 = subprocess.Popen(['curl', '-L', '--fail', '-s', url], stdout=subprocess.PIPE)
@@ -1,8 +1,8 @@
 #!/usr/bin/env python
-from __future__ import absolute_import, unicode_literals
 import os
 import subprocess
 import math
+import requests
 
 from . import download
 from . import log
@@ -61,7 +61,10 @@ class ElevationDownloader(object):
         raise NotImplementedError
 
     def _download(self, url, op):
-        download.download(url, op)
+        try:
+            download.download(url, op)
+        except requests.HTTPError as e:
+            log.warning('could not download %s: %s'%(url, e))
 
 class ElevationGeotiffDownloader(ElevationDownloader):
     def __init__(self, *args, **kwargs):
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from __future__ import absolute_import, unicode_literals, print_function
 import argparse
 from .planet import *
 from . import bbox
@@ -16,6 +15,8 @@ def main():
     parser.add_argument('--verbose', help="Verbose output", action='store_true')
     parser.add_argument('--toolchain', help='OSM toolchain', default='osmosis')
     parser.add_argument('--strategy', help='Osmium extract strategy: simple, complete_ways, or smart', default='complete_ways')
+    parser.add_argument('--workers', help='Number of worker threads or processes; keep low if the planet is on a single HDD', type=int, default=1)
+    parser.add_argument('--single-pass', help='osmctools toolchain: cut all bounding boxes in a single osmium pass over the planet', action='store_true')
     parser.add_argument('--commands', help='Output a command list instead of performing action, e.g. for parallel usage', action='store_true')
     args = parser.parse_args()
 
@@ -42,11 +43,11 @@ def main():
         parser.error('must specify --csv, --geojson, or --bbox and --name')
 
     if args.commands:
-        commands = p.extract_commands(bboxes, outpath=args.outpath, strategy=args.strategy)
+        commands = p.extract_commands(bboxes, outpath=args.outpath, strategy=args.strategy, workers=args.workers)
         for i in commands:
             print(" ".join(i))
     else:
-        p.extract_bboxes(bboxes, outpath=args.outpath, strategy=args.strategy)
+        p.extract_bboxes(bboxes, outpath=args.outpath, strategy=args.strategy, workers=args.workers, single_pass=args.single_pass)
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from __future__ import absolute_import, unicode_literals, print_function
 import argparse
 from .planet import *
 from . import log
@@ -7,10 +6,11 @@ from . import log
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('osmpath', help='OSM file')
+    parser.add_argument('--statistics', help='If the file header has no timestamp, scan it with osmconvert --out-statistics instead of osmium fileinfo', action='store_true')
     args = parser.parse_args()
     p = Planet(args.osmpath)
     log.set_quiet()
-    print(p.get_timestamp())
+    print(p.get_timestamp(statistics=args.statistics))
 
 if __name__ == '__main__':
     main()
@@ -1,5 +1,4 @@
 #!/usr/bin/env python
-from __future__ import absolute_import, unicode_literals
 import argparse
 
 from . import log
@@ -13,6 +12,7 @@ def main():
     parser.add_argument('--s3', action='store_true', help='Download using S3 client from AWS Public Datasets program. AWS credentials required.')
     parser.add_argument('--workdir', help="Osmosis replication workingDirectory.", default='.')
     parser.add_argument('--verbose', help="Verbose output", action='store_true')
+    parser.add_argument('--apply-changes', help='Osmosis toolchain: apply changesets with osmosis or osmium', choices=['osmosis', 'osmium'], default='osmosis')
     parser.add_argument('--size', help='Osmium update memory limit', default='1024')
     args = parser.parse_args()
 
@@ -28,7 +28,7 @@ def main():
         d.download_planet()
 
     if args.toolchain == 'osmosis':
-        p = PlanetUpdaterOsmosis(args.osmpath)
+        p = PlanetUpdaterOsmosis(args.osmpath, apply_changes=args.apply_changes)
     elif args.toolchain == 'osmium':
         p = PlanetUpdaterOsmium(args.osmpath)
     else:
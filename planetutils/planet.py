@@ -1,85 +1,190 @@
 #!/usr/bin/env python
-from __future__ import absolute_import, unicode_literals
-from future.standard_library import install_aliases
-install_aliases()
 from urllib.parse import urlparse, urlencode
 from urllib.request import urlopen
+from urllib.error import URLError
 
 import re
+import io
 import os
+import datetime
+import shutil
+import time
 import subprocess
 import tempfile
+import threading
 import json
+from concurrent.futures import ThreadPoolExecutor
+from shutil import which
 
 from . import log
 from .bbox import validate_bbox
+from .download import download_ranges
 
 try:
     import boto3
+    from boto3.s3.transfer import TransferConfig
 except ImportError:
     boto3 = None
 
+_TIMESTAMP_CACHE = {}
+STATE_RETRIES = 3
+_PLANET_RE = re.compile(r'.*(planet[-_:T0-9]+\.osm\.pbf)$')
+
 class PlanetBase(object):
     def __init__(self, osmpath=None, grain='hour', changeset_url=None, osmosis_workdir=None):
         self.osmpath = osmpath
         d, p = os.path.split(osmpath)
         self.osmosis_workdir = osmosis_workdir or os.path.join(d, '%s.workdir'%p)
 
-    def command(self, args):
+    def command(self, args, predicate=None):
+        if predicate:
+            return self._command_stream(args, predicate)
         log.debug(args)
         return subprocess.check_output(
             args,
             shell=False
         ).decode('utf-8')
 
-    def osmosis(self, *args):
-        return self.command(['osmosis'] + list(args))
-
-    def osmconvert(self, *args):
-        return self.command(['osmconvert'] + list(args))
-
-    def get_timestamp(self):
+    def _command_stream(self, args, predicate):
+        # Return the first line of output matching predicate, then stop the process.
+        log.debug(args)
+        p = subprocess.Popen(args, stdout=subprocess.PIPE, bufsize=1<<16)
+        try:
+            for line in io.TextIOWrapper(p.stdout, encoding='utf-8'):
+                if predicate(line):
+                    return line
+        finally:
+            if p.poll() is None:
+                p.terminate()
+            p.stdout.close()
+            p.wait()
+        if p.returncode:
+            raise subprocess.CalledProcessError(p.returncode, args)
+
+    def osmosis(self, *args, **kw):
+        return self.command(['osmosis'] + list(args), **kw)
+
+    def osmconvert(self, *args, **kw):
+        return self.command(['osmconvert'] + list(args), **kw)
+
+    def get_timestamp(self, statistics=False):
+        # Cache on path, mtime, and size, both in memory and in a sidecar file.
+        st = os.stat(self.osmpath)
+        key = [os.path.abspath(self.osmpath), st.st_mtime_ns, st.st_size]
+        timestamp = _TIMESTAMP_CACHE.get(tuple(key))
+        if timestamp:
+            return timestamp
+        sidecar = '%s.timestamp'%self.osmpath
+        try:
+            with open(sidecar) as f:
+                data = json.load(f)
+            if data.get('key') == key:
+                timestamp = data.get('timestamp')
+        except (IOError, OSError, ValueError):
+            pass
+        if not timestamp:
+            timestamp = self._get_timestamp(statistics=statistics)
+            try:
+                with open(sidecar, 'w') as f:
+                    json.dump({'key': key, 'timestamp': timestamp}, f)
+            except (IOError, OSError) as e:
+                log.debug('could not write timestamp cache: %s'%e)
+        _TIMESTAMP_CACHE[tuple(key)] = timestamp
+        return timestamp
+
+    def _get_timestamp(self, statistics=False):
         timestamp = self.osmconvert(
             self.osmpath,
             '--out-timestamp'
         )
-        if 'invalid' in timestamp:
-            log.debug('no timestamp; falling back to osmconvert --out-statistics')
-            statistics = self.osmconvert(
-                self.osmpath,
-                '--out-statistics'
-            )
-            timestamp = [
-                i.partition(':')[2].strip() for i in statistics.split('\n')
-                if i.startswith('timestamp max')
-            ][0]
-        return timestamp.strip()
+        if 'invalid' not in timestamp:
+            return timestamp.strip()
+        if not statistics and which('osmium'):
+            log.debug('no timestamp; falling back to osmium fileinfo')
+            timestamp = self.command([
+                'osmium', 'fileinfo',
+                '-e',
+                '-g', 'data.timestamp.last',
+                self.osmpath
+            ])
+            return timestamp.strip()
+        log.debug('no timestamp; falling back to osmconvert --out-statistics')
+        line = self.osmconvert(
+            self.osmpath,
+            '--out-statistics',
+            predicate=lambda i: i.startswith('timestamp max')
+        )
+        if not line:
+            raise Exception('no timestamp found: %s'%self.osmpath)
+        return line.partition(':')[2].strip()
 
 class Planet(PlanetBase):
     pass
 
 class PlanetExtractor(PlanetBase):
+    def __init__(self, *args, **kw):
+        super(PlanetExtractor, self).__init__(*args, **kw)
+        self._commands_lock = threading.Lock()
+
     def extract_bboxes(self, bboxes, workers=1, outpath='.'):
         raise NotImplementedError
 
     def extract_bbox(self, name, bbox, workers=1, outpath='.'):
         return self.extract_bboxes({name: bbox}, outpath=outpath, workers=workers)
 
+    def _validate_bboxes(self, bboxes):
+        # Validate all bboxes before any work starts. Call Feature.bbox() once;
+        # Feature.__getitem__ recomputes it on every index.
+        ret = {}
+        for name, bbox in bboxes.items():
+            if hasattr(bbox, 'bbox'):
+                bbox = bbox.bbox()
+            ret[name] = validate_bbox(bbox)
+        return ret
+
     def extract_commands(self, bboxes, outpath='.', **kw):
+        # Collect commands by temporarily overriding self.command.
         args = []
-        self.command = lambda x:args.append(x)
-        self.extract_bboxes(bboxes, outpath=outpath, **kw)
+        with self._commands_lock:
+            command = self.__dict__.get('command')
+            self.command = lambda x:args.append(x)
+            try:
+                self.extract_bboxes(bboxes, outpath=outpath, **kw)
+            finally:
+                if command is None:
+                    del self.command
+                else:
+                    self.command = command
         return args
 
+    def osmium_extract(self, extracts, outpath='.', strategy='complete_ways', overwrite=False):
+        args = ['osmium', 'extract', '-s', strategy]
+        if overwrite:
+            args.append('--overwrite')
+        # A single rectangle can be passed on the command line; no config file.
+        if len(extracts) == 1 and 'bbox' in extracts[0]:
+            ext = extracts[0]
+            b = ext['bbox']
+            return self.command(args + [
+                '-b', '%s,%s,%s,%s'%(b['left'], b['bottom'], b['right'], b['top']),
+                '-f', ext['output_format'],
+                '-o', os.path.join(outpath, ext['output']),
+                self.osmpath
+            ])
+        config = {'directory': outpath, 'extracts': extracts}
+        with tempfile.NamedTemporaryFile(mode='w', suffix='.json') as f:
+            json.dump(config, f)
+            f.flush()
+            return self.command(args + ['-c', f.name, self.osmpath])
+
 class PlanetExtractorOsmosis(PlanetExtractor):
     def extract_bboxes(self, bboxes, workers=1, outpath='.', **kw):
+        bboxes = self._validate_bboxes(bboxes)
         args = []
         args += ['--read-pbf-fast', self.osmpath, 'workers=%s'%int(workers)]
         args += ['--tee', str(len(bboxes))]
-        for name, bbox in bboxes.items():
-            validate_bbox(bbox)
-            left, bottom, right, top = bbox
-            arg = [
+        for name, (left, bottom, right, top) in bboxes.items():
+            args.extend((
                 '--bounding-box',
                 'left=%0.5f'%left,
                 'bottom=%0.5f'%bottom,
@@ -87,17 +192,42 @@ class PlanetExtractorOsmosis(PlanetExtractor):
                 'top=%0.5f'%top,
                 '--write-pbf',
                 os.path.join(outpath, '%s.osm.pbf'%name)
-            ]
-            args += arg
+            ))
         self.osmosis(*args)
 
 class PlanetExtractorOsmconvert(PlanetExtractor):
-    def extract_bboxes(self, bboxes, workers=1, outpath='.', **kw):
-        for name, bbox in bboxes.items():
-            self.extract_bbox(name, bbox, outpath=outpath)
-
-    def extract_bbox(self, name, bbox, workers=1, outpath='.', **kw):
-        validate_bbox(bbox)
+    def extract_bboxes(self, bboxes, workers=1, outpath='.', single_pass=False, **kw):
+        bboxes = self._validate_bboxes(bboxes)
+        # osmconvert writes one output per pass over the planet; optionally
+        # cut all bboxes in a single osmium pass instead.
+        if single_pass and len(bboxes) > 1:
+            extracts = []
+            for name, (left, bottom, right, top) in bboxes.items():
+                extracts.append({
+                    'output': '%s.osm.pbf'%name,
+                    'output_format': 'pbf',
+                    'bbox': {'left': left, 'right': right, 'top': top, 'bottom':bottom}
+                })
+            return self.osmium_extract(extracts, outpath=outpath, strategy='simple', overwrite=True)
+        workers = int(workers)
+        if workers <= 1:
+            for name, bbox in bboxes.items():
+                self._extract_bbox(name, bbox, outpath=outpath)
+            return
+        # Each osmconvert process re-reads the planet; if the planet is on a
+        # single spinning disk, keep workers <= 2 to avoid seek thrashing.
+        with ThreadPoolExecutor(max_workers=workers) as ex:
+            list(ex.map(
+                lambda kv: self._extract_bbox(kv[0], kv[1], outpath=outpath),
+                bboxes.items()
+            ))
+
+    def extract_commands(self, bboxes, outpath='.', single_pass=False, workers=1, **kw):
+        # Planned commands must run on their own; the osmium config file is temporary.
+        # Plan sequentially so commands are listed in bbox order.
+        return super(PlanetExtractorOsmconvert, self).extract_commands(bboxes, outpath=outpath, **kw)
+
+    def _extract_bbox(self, name, bbox, outpath='.'):
         left, bottom, right, top = bbox
         args = [
             self.osmpath,
@@ -108,8 +238,9 @@ class PlanetExtractorOsmconvert(PlanetExtractor):
 
 class PlanetExtractorOsmium(PlanetExtractor):
     def extract_bboxes(self, bboxes, workers=1, outpath='.', strategy='complete_ways', **kw):
+        self._validate_bboxes(bboxes)
         extracts = []
-        for name, bbox in bboxes.items():            
+        for name, bbox in bboxes.items():
             ext = {
                 'output': '%s.osm.pbf'%name,
                 'output_format': 'pbf',
@@ -121,67 +252,88 @@ class PlanetExtractorOsmium(PlanetExtractor):
                 ftype = bbox.geometry.get('type', '').lower()
                 ext[ftype] = bbox.geometry.get('coordinates', [])
             extracts.append(ext)
-        config = {'directory': outpath, 'extracts': extracts}
-        path = None
-        with tempfile.NamedTemporaryFile(mode='w', delete=False) as f:
-            json.dump(config, f)
-            path = f.name
-        self.command(['osmium', 'extract', '-s', strategy, '-c', path, self.osmpath])
-        os.unlink(path)
+        self.osmium_extract(extracts, outpath=outpath, strategy=strategy)
 
 class PlanetDownloader(PlanetBase):
     def download_planet(self):
         raise NotImplementedError
 
-class PlanetDownloaderHttp(PlanetBase):
+    def _download_part(self, *args):
+        # Download to osmpath.part, reserved with O_EXCL so that concurrent runs
+        # fail cleanly, and move it into place only once complete.
+        if os.path.exists(self.osmpath):
+            raise Exception('planet file exists: %s'%self.osmpath)
+        partpath = '%s.part'%self.osmpath
+        try:
+            os.close(os.open(partpath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            raise Exception('partial download exists; remove it if no other download is running: %s'%partpath)
+        try:
+            self._download(*args, partpath)
+        except BaseException:
+            os.unlink(partpath)
+            raise
+        os.rename(partpath, self.osmpath)
+
+class PlanetDownloaderHttp(PlanetDownloader):
     def _download(self, url, outpath):
-        subprocess.check_output([
-            'curl',
-            '-L',
-            '-o', outpath,
-            url
-        ])
+        download_ranges(url, outpath)
 
     def download_planet(self, url=None):
-        if os.path.exists(self.osmpath):
-            raise Exception('planet file exists: %s'%self.osmpath)
         url = url or 'https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf'
-        self._download(url, self.osmpath)
+        self._download_part(url)
+
+class PlanetDownloaderS3(PlanetDownloader):
+    def __init__(self, osmpath=None, max_concurrency=16, **kw):
+        super(PlanetDownloaderS3, self).__init__(osmpath, **kw)
+        self.max_concurrency = max_concurrency
 
-class PlanetDownloaderS3(PlanetBase):
     def download_planet(self):
         self.download_planet_latest()
 
     def download_planet_latest(self, bucket=None, prefix=None, match=None):
         if os.path.exists(self.osmpath):
             raise Exception('planet file exists: %s'%self.osmpath)
-        match = match or '.*(planet[-_:T0-9]+.osm.pbf)$'
+        match = re.compile(match) if match else _PLANET_RE
+        prefixes = [prefix]
+        if bucket is None and prefix is None:
+            # osm-pds keeps planets in yearly directories; avoid listing
+            # the whole bucket unless the recent years are empty.
+            year = datetime.datetime.now(datetime.timezone.utc).year
+            prefixes = ['%s/'%year, '%s/'%(year-1), None]
         bucket = bucket or 'osm-pds'
-        objs = self._get_planets(bucket, prefix, match)
-        objs = sorted(objs, key=lambda x:x.key)
-        for i in objs:
-            log.info('found planet: s3://%s/%s'%(i.bucket_name, i.key))
-        planet = objs[-1]
-        log.info('downloading: s3://%s/%s to %s'%(planet.bucket_name, planet.key, self.osmpath))
-        self._download(planet.bucket_name, planet.key)
-
-    def _download(self, bucket_name, key):
+        # planet keys embed their date, so the greatest key is the latest
+        planet = None
+        for prefix in prefixes:
+            planet = max(self._get_planets(bucket, prefix, match), key=lambda x:x['Key'], default=None)
+            if planet:
+                break
+        if not planet:
+            raise Exception('no planet found in bucket: %s'%bucket)
+        log.info('downloading: s3://%s/%s to %s'%(bucket, planet['Key'], self.osmpath))
+        self._download_part(bucket, planet['Key'])
+
+    def _download(self, bucket_name, key, outpath):
         if not boto3:
             raise Exception('please install boto3')
+        config = TransferConfig(
+            multipart_threshold=8*1024*1024,
+            multipart_chunksize=64*1024*1024,
+            max_concurrency=self.max_concurrency,
+            use_threads=True
+        )
         s3 = boto3.client('s3')
-        s3.download_file(bucket_name, key, self.osmpath)
+        s3.download_file(bucket_name, key, outpath, Config=config)
 
     def _get_planets(self, bucket, prefix, match):
         if not boto3:
             raise Exception('please install boto3')
-        r = re.compile(match)
-        s3 = boto3.resource('s3')
-        s3bucket = s3.Bucket(bucket)
-        objs = []
-        for obj in s3bucket.objects.filter(Prefix=(prefix or '')):
-            if r.match(obj.key):
-                objs.append(obj)
-        return objs
+        paginator = boto3.client('s3').get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=(prefix or '')):
+            for obj in page.get('Contents', ()):
+                if match.match(obj['Key']):
+                    log.debug('found planet: s3://%s/%s'%(bucket, obj['Key']))
+                    yield obj
 
 
 class PlanetUpdater(PlanetBase):
@@ -198,25 +350,35 @@ class PlanetUpdaterOsmium(PlanetBase):
         self.command(['pyosmium-up-to-date', '-s', size, '-v', self.osmpath, '-o', outpath])
 
 class PlanetUpdaterOsmosis(PlanetBase):
+    def __init__(self, osmpath=None, apply_changes='osmosis', **kw):
+        super(PlanetUpdaterOsmosis, self).__init__(osmpath, **kw)
+        if apply_changes not in ('osmosis', 'osmium'):
+            raise Exception('unknown apply_changes tool: %s'%apply_changes)
+        self.apply_changes = apply_changes
+
     def update_planet(self, outpath, grain='minute', changeset_url=None, **kw):
         if not os.path.exists(self.osmpath):
             raise Exception('planet file does not exist: %s'%self.osmpath)
         self.changeset_url = changeset_url or 'https://planet.openstreetmap.org/replication/%s'%grain
         self._initialize()
         self._initialize_state()
-        self._get_changeset()
-        self._apply_changeset(outpath)
+        if self.apply_changes == 'osmium':
+            self._get_changeset()
+            self._apply_changeset_osmium(outpath)
+        else:
+            self._get_and_apply_changeset(outpath)
 
     def _initialize(self):
         configpath = os.path.join(self.osmosis_workdir, 'configuration.txt')
-        if os.path.exists(configpath):
-            return
-        if os.path.exists(self.osmosis_workdir) and not os.path.isdir(self.osmosis_workdir):
-            raise Exception('workdir exists and is not a directory: %s'%self.osmosis_workdir)
         try:
-            os.makedirs(self.osmosis_workdir)
-        except OSError as e:
+            os.stat(configpath)
+            return
+        except OSError:
             pass
+        try:
+            os.makedirs(self.osmosis_workdir, exist_ok=True)
+        except FileExistsError:
+            raise Exception('workdir exists and is not a directory: %s'%self.osmosis_workdir)
         self.osmosis(
             '--read-replication-interval-init',
             'workingDirectory=%s'%self.osmosis_workdir
@@ -233,9 +395,21 @@ class PlanetUpdaterOsmosis(PlanetBase):
             return
         timestamp = self.get_timestamp()
         url = 'https://replicate-sequences.osm.mazdermind.de/?%s'%timestamp
-        state = urlopen(url).read()
-        with open(statepath, 'w') as f:
-            f.write(state)
+        tmppath = '%s.tmp'%statepath
+        for attempt in range(STATE_RETRIES):
+            try:
+                with urlopen(url, timeout=30) as r, open(tmppath, 'wb') as f:
+                    shutil.copyfileobj(r, f, 1<<16)
+                break
+            except (URLError, OSError) as e:
+                # read timeouts raise socket.timeout, which is not a URLError
+                if attempt == STATE_RETRIES - 1:
+                    if os.path.exists(tmppath):
+                        os.unlink(tmppath)
+                    raise
+                log.warning('could not get replication state, retrying: %s'%e)
+                time.sleep(2**attempt)
+        os.rename(tmppath, statepath)
 
     def _get_changeset(self):
         self.osmosis(
@@ -246,13 +420,25 @@ class PlanetUpdaterOsmosis(PlanetBase):
             os.path.join(self.osmosis_workdir, 'changeset.osm.gz')
         )
 
-    def _apply_changeset(self, outpath):
+    def _get_and_apply_changeset(self, outpath):
+        # One osmosis pipeline: no intermediate changeset file, one JVM startup.
         self.osmosis(
-            '--read-xml-change',
-            os.path.join(self.osmosis_workdir, 'changeset.osm.gz'),
+            '--read-replication-interval',
+            'workingDirectory=%s'%self.osmosis_workdir,
+            '--simplify-change',
             '--read-pbf',
             self.osmpath,
             '--apply-change',
             '--write-pbf',
             outpath
         )
+
+    def _apply_changeset_osmium(self, outpath):
+        # osmium apply-changes decodes on multiple threads; osmosis does not.
+        self.command([
+            'osmium', 'apply-changes',
+            '--overwrite',
+            '-o', outpath,
+            self.osmpath,
+            os.path.join(self.osmosis_workdir, 'changeset.osm.gz')
+        ])
@@ -16,8 +16,9 @@ setup(name='interline-planetutils',
     author='Ian Rees',
     author_email='ian@interline.io',
     license='MIT',
+    python_requires='>=3.6',
     packages=find_packages(exclude=['contrib', 'docs', 'tests']),
-    install_requires=['future', 'requests'], #, 'osmium', 'boto3'
+    install_requires=['requests'], #, 'osmium', 'boto3'
     tests_require=['nose'],
     test_suite = 'nose.collector',
     entry_points={
@@ -36,7 +37,8 @@ setup(name='interline-planetutils',
         'Development Status :: 5 - Production/Stable',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7'
     ]
 )
@@ -1,5 +1,3 @@
-from __future__ import absolute_import, unicode_literals
-from builtins import zip
 import tempfile
 import os
 import unittest
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import unittest
+import requests
+
+import planetutils.download as download
+
+DATA = b'0123456789abcdefghij'
+
+class Response(object):
+    def __init__(self, url, status_code=200, headers=None, body=b''):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.body = body
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(self.status_code)
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i:i+chunk_size]
+
+    def close(self):
+        pass
+
+class Requests(object):
+    # mock requests: serves DATA, optionally with Range support
+    RequestException = requests.RequestException
+
+    def __init__(self, head_status=200, ranges=True, failures=0, short=0, get_status=200):
+        self.head_status = head_status
+        self.get_status = get_status
+        self.ranges = ranges
+        self.failures = failures
+        self.short = short
+        self.gets = []
+
+    def head(self, url, allow_redirects=False, timeout=None):
+        assert timeout
+        headers = {'Content-Length': str(len(DATA))}
+        if self.ranges:
+            headers['Accept-Ranges'] = 'bytes'
+        return Response(url, self.head_status, headers)
+
+    def get(self, url, headers=None, stream=False, timeout=None):
+        rng = (headers or {}).get('Range')
+        self.gets.append(rng)
+        assert timeout
+        if self.get_status != 200:
+            return Response(url, self.get_status, body=b'<html>error</html>')
+        if not rng:
+            return Response(url, 200, body=DATA)
+        if self.failures:
+            self.failures -= 1
+            raise requests.ConnectionError('test')
+        start, _, end = rng.partition('=')[2].partition('-')
+        body = DATA[int(start):int(end)+1]
+        if self.short:
+            self.short -= 1
+            body = body[:-1]
+        if not self.ranges:
+            return Response(url, 200, body=DATA)
+        return Response(url, 206, body=body)
+
+class TestDownloadRanges(unittest.TestCase):
+    def setUp(self):
+        self.d = tempfile.mkdtemp()
+        self.outpath = os.path.join(self.d, 'test.bin')
+        self.requests = download.requests
+
+    def tearDown(self):
+        download.requests = self.requests
+        shutil.rmtree(self.d)
+
+    def download_ranges(self, r, **kw):
+        download.requests = r
+        download.download_ranges('http://example.com/test.bin', self.outpath, workers=2, chunk_size=6, **kw)
+        with open(self.outpath, 'rb') as f:
+            return f.read()
+
+    def test_ranges(self):
+        r = Requests()
+        self.assertEqual(self.download_ranges(r), DATA)
+        self.assertEqual(sorted(r.gets), ['bytes=0-5', 'bytes=12-17', 'bytes=18-19', 'bytes=6-11'])
+
+    def test_range_ignored(self):
+        r = Requests()
+        r.head = lambda url, **kw: Response(url, 200, {'Content-Length': str(len(DATA)), 'Accept-Ranges': 'bytes'})
+        r.ranges = False
+        self.assertEqual(self.download_ranges(r), DATA)
+        self.assertIn(None, r.gets)
+
+    def test_no_accept_ranges(self):
+        r = Requests(ranges=False)
+        self.assertEqual(self.download_ranges(r), DATA)
+        self.assertEqual(r.gets, [None])
+
+    def test_head_rejected(self):
+        r = Requests(head_status=405)
+        self.assertEqual(self.download_ranges(r), DATA)
+        self.assertEqual(r.gets, [None])
+
+    def test_not_found(self):
+        r = Requests(head_status=404, get_status=404)
+        with self.assertRaises(requests.HTTPError):
+            self.download_ranges(r)
+        self.assertEqual(r.gets, [None])
+        self.assertFalse(os.path.exists(self.outpath))
+
+    def test_retry(self):
+        r = Requests(failures=1, short=1)
+        self.assertEqual(self.download_ranges(r, retries=3), DATA)
+        self.assertEqual(len(r.gets), 6)
+
+    def test_short_read(self):
+        r = Requests(short=100)
+        with self.assertRaises(download.ShortRead):
+            self.download_ranges(r, retries=1)
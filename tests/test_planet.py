@@ -1,9 +1,14 @@
-from __future__ import absolute_import, unicode_literals
+import io
+import sys
+import subprocess
+import socket
 import tempfile
+import shutil
 import types
 import os
 import unittest
 import planetutils.planet as planet
+import planetutils.bbox as bbox
 
 TESTFILE = os.path.join('.','examples','san-francisco-downtown.osm.pbf')
 TESTFILE_TIMESTAMP = '2018-02-02T22:34:43Z'
@@ -27,9 +32,57 @@ class TestPlanetBase(unittest.TestCase):
         output = p.osmconvert(p.osmpath, '--out-statistics')
         self.assertIn('timestamp min:', output)
     
-    def test_get_timestamp(self):
+    def test_command_predicate(self):
+        p = planet.PlanetBase(TESTFILE)
+        script = 'import sys; print("a"); print("timestamp max: 1"); print("b"); sys.exit(%s)'
+        line = p.command([sys.executable, '-c', script%0], predicate=lambda i: i.startswith('timestamp max'))
+        self.assertEqual(line.strip(), 'timestamp max: 1')
+        line = p.command([sys.executable, '-c', script%0], predicate=lambda i: i.startswith('missing'))
+        self.assertIsNone(line)
+        with self.assertRaises(subprocess.CalledProcessError):
+            p.command([sys.executable, '-c', script%3], predicate=lambda i: i.startswith('missing'))
+
+    def test_get_timestamp_statistics(self):
         p = planet.PlanetBase(TESTFILE)
+        COMMANDS = []
+        def c(args, predicate=None):
+            COMMANDS.append(args)
+            if predicate:
+                return 'timestamp max: %s\n'%TESTFILE_TIMESTAMP
+            return '(invalid timestamp)'
+        p.command = c
+        self.assertEqual(p._get_timestamp(statistics=True), TESTFILE_TIMESTAMP)
+        self.assertEqual(COMMANDS[-1], ['osmconvert', TESTFILE, '--out-statistics'])
+
+    def test_get_timestamp(self):
+        # copy the fixture; get_timestamp writes a sidecar cache file
+        d = tempfile.mkdtemp()
+        outfile = os.path.join(d, 'test.osm.pbf')
+        shutil.copy(TESTFILE, outfile)
+        p = planet.PlanetBase(outfile)
         self.assertEqual(p.get_timestamp(), TESTFILE_TIMESTAMP)
+        shutil.rmtree(d)
+
+    def test_get_timestamp_cached(self):
+        d = tempfile.mkdtemp()
+        outfile = os.path.join(d, 'test.osm.pbf')
+        shutil.copy(TESTFILE, outfile)
+        COUNT = []
+        def c(self, statistics=False):
+            COUNT.append(self.osmpath)
+            return TESTFILE_TIMESTAMP
+        p = planet.PlanetBase(outfile)
+        p._get_timestamp = types.MethodType(c, p)
+        self.assertEqual(p.get_timestamp(), TESTFILE_TIMESTAMP)
+        self.assertEqual(p.get_timestamp(), TESTFILE_TIMESTAMP)
+        self.assertEqual(len(COUNT), 1)
+        # sidecar file is used by new instances
+        planet._TIMESTAMP_CACHE.clear()
+        p2 = planet.PlanetBase(outfile)
+        p2._get_timestamp = types.MethodType(c, p2)
+        self.assertEqual(p2.get_timestamp(), TESTFILE_TIMESTAMP)
+        self.assertEqual(len(COUNT), 1)
+        shutil.rmtree(d)
 
 class TestPlanetExtractor(unittest.TestCase):
     kls = None
@@ -43,29 +96,246 @@ class TestPlanetExtractor(unittest.TestCase):
         self.assertTrue(os.path.exists(outfile))
         p2 = planet.PlanetBase(outfile)
         self.assertEqual(p2.get_timestamp(), TESTFILE_TIMESTAMP)
-        os.unlink(outfile)
-        os.rmdir(d)
+        shutil.rmtree(d)
+
+    def test_extract_bboxes_invalid_bbox(self):
+        if self.kls is None:
+            self.skipTest('no extractor class')
+        p = self.kls(TESTFILE)
+        COMMANDS = []
+        p.command = lambda x:COMMANDS.append(x)
+        with self.assertRaises(AssertionError):
+            p.extract_bboxes({'a': TEST_BBOX, 'b': [0.0, 10.0, 1.0, -10.0]})
+        self.assertEqual(COMMANDS, [])
+
+    def test_extract_commands_restores_command(self):
+        if self.kls is None:
+            self.skipTest('no extractor class')
+        p = self.kls(TESTFILE)
+        with self.assertRaises(AssertionError):
+            p.extract_commands({'a': [0.0, 10.0, 1.0, -10.0]})
+        self.assertNotIn('command', p.__dict__)
+        command = lambda x:None
+        p.command = command
+        f = bbox.Feature()
+        f.set_bbox(TEST_BBOX)
+        p.extract_commands({'a': f})
+        self.assertIs(p.command, command)
+
+class TestPlanetExtractorLock(unittest.TestCase):
+    def test_commands_lock_per_instance(self):
+        p1 = planet.PlanetExtractorOsmosis(TESTFILE)
+        p2 = planet.PlanetExtractorOsmosis(TESTFILE)
+        self.assertIsNot(p1._commands_lock, p2._commands_lock)
+        with p1._commands_lock:
+            commands = p2.extract_commands({'a': TEST_BBOX})
+        self.assertEqual(len(commands), 1)
 
 class TestPlanetExtractorOsmconvert(TestPlanetExtractor):
     kls = planet.PlanetExtractorOsmconvert
     def test_extract_bbox(self):
         self.extract_bbox()
 
+    def test_extract_commands(self):
+        p = self.kls(TESTFILE)
+        commands = p.extract_commands({'a': TEST_BBOX, 'b': TEST_BBOX}, single_pass=True)
+        self.assertEqual(len(commands), 2)
+        for i in commands:
+            self.assertEqual(i[0], 'osmconvert')
+
+    def test_extract_commands_order(self):
+        p = self.kls(TESTFILE)
+        names = ['b%s'%i for i in range(20)]
+        commands = p.extract_commands(dict((i, TEST_BBOX) for i in names), workers=4)
+        self.assertEqual([i[-1] for i in commands], ['-o=%s'%os.path.join('.', '%s.osm.pbf'%i) for i in names])
+
+    def test_extract_bboxes_workers(self):
+        p = self.kls(TESTFILE)
+        COMMANDS = []
+        p.command = lambda x:COMMANDS.append(x)
+        WORKERS = []
+        class Executor(planet.ThreadPoolExecutor):
+            def __init__(self, max_workers=None):
+                WORKERS.append(max_workers)
+                super(Executor, self).__init__(max_workers=max_workers)
+        executor = planet.ThreadPoolExecutor
+        planet.ThreadPoolExecutor = Executor
+        try:
+            p.extract_bboxes({'a': TEST_BBOX, 'b': TEST_BBOX}, workers=3)
+        finally:
+            planet.ThreadPoolExecutor = executor
+        self.assertEqual(WORKERS, [3])
+        self.assertEqual(len(COMMANDS), 2)
+
+    def test_extract_bboxes_single_pass(self):
+        p = self.kls(TESTFILE)
+        COMMANDS = []
+        p.command = lambda x:COMMANDS.append(x)
+        p.extract_bboxes({'a': TEST_BBOX, 'b': TEST_BBOX}, single_pass=True)
+        self.assertEqual(len(COMMANDS), 1)
+        self.assertEqual(COMMANDS[0][:2], ['osmium', 'extract'])
+        self.assertIn('--overwrite', COMMANDS[0])
+        self.assertEqual(COMMANDS[0][COMMANDS[0].index('-s')+1], 'simple')
+
 class TestPlanetExtractorOsmosis(TestPlanetExtractor):
     kls = planet.PlanetExtractorOsmosis
     def test_extract_bbox(self):
         self.extract_bbox()
 
+class TestPlanetExtractorOsmium(TestPlanetExtractor):
+    kls = planet.PlanetExtractorOsmium
+    def test_extract_commands_bbox(self):
+        p = self.kls(TESTFILE)
+        f = bbox.Feature()
+        f.set_bbox(TEST_BBOX)
+        commands = p.extract_commands({'test': f}, outpath='out')
+        self.assertEqual(len(commands), 1)
+        self.assertIn('-b', commands[0])
+        self.assertNotIn('-c', commands[0])
+        self.assertIn(os.path.join('out', 'test.osm.pbf'), commands[0])
+
 class TestPlanetDownloaderHttp(unittest.TestCase):
     def test_download_planet(self):
-        p = planet.PlanetDownloaderHttp('test.osm.pbf')
-        # mock curl
+        d = tempfile.mkdtemp()
+        outfile = os.path.join(d, 'test.osm.pbf')
+        p = planet.PlanetDownloaderHttp(outfile)
+        # mock download
         COUNT = []
         def c(self, url, outpath):
             COUNT.append([url,outpath])
         p._download = types.MethodType(c, planet.PlanetDownloaderHttp)
         p.download_planet()
-        self.assertEqual(COUNT[0], ['https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf', 'test.osm.pbf'])
-        
+        self.assertEqual(COUNT[0], ['https://planet.openstreetmap.org/pbf/planet-latest.osm.pbf', outfile + '.part'])
+        self.assertTrue(os.path.exists(outfile))
+        self.assertFalse(os.path.exists(outfile + '.part'))
+        shutil.rmtree(d)
+
+    def test_download_planet_failed(self):
+        d = tempfile.mkdtemp()
+        outfile = os.path.join(d, 'test.osm.pbf')
+        p = planet.PlanetDownloaderHttp(outfile)
+        def c(self, url, outpath):
+            raise IOError('test')
+        p._download = types.MethodType(c, planet.PlanetDownloaderHttp)
+        with self.assertRaises(IOError):
+            p.download_planet()
+        self.assertFalse(os.path.exists(outfile))
+        self.assertFalse(os.path.exists(outfile + '.part'))
+        shutil.rmtree(d)
+
+    def test_download_planet_in_progress(self):
+        d = tempfile.mkdtemp()
+        outfile = os.path.join(d, 'test.osm.pbf')
+        with open(outfile + '.part', 'w') as f:
+            f.write('')
+        p = planet.PlanetDownloaderHttp(outfile)
+        COUNT = []
+        def c(self, url, outpath):
+            COUNT.append([url,outpath])
+        p._download = types.MethodType(c, planet.PlanetDownloaderHttp)
+        with self.assertRaises(Exception):
+            p.download_planet()
+        self.assertEqual(COUNT, [])
+        shutil.rmtree(d)
+
+class TestPlanetUpdaterOsmosis(unittest.TestCase):
+    def test_initialize_state(self):
+        d = tempfile.mkdtemp()
+        p = planet.PlanetUpdaterOsmosis(TESTFILE, osmosis_workdir=d)
+        p.get_timestamp = lambda: TESTFILE_TIMESTAMP
+        URLS = []
+        def u(url, timeout=None):
+            URLS.append(url)
+            if len(URLS) == 1:
+                raise planet.URLError('test')
+            return io.BytesIO(b'sequenceNumber=1\n')
+        urlopen = planet.urlopen
+        planet.urlopen = u
+        try:
+            p._initialize_state()
+        finally:
+            planet.urlopen = urlopen
+        self.assertEqual(len(URLS), 2)
+        self.assertIn(TESTFILE_TIMESTAMP, URLS[0])
+        with open(os.path.join(d, 'state.txt')) as f:
+            self.assertEqual(f.read(), 'sequenceNumber=1\n')
+        shutil.rmtree(d)
+
+    def test_initialize_state_timeout(self):
+        d = tempfile.mkdtemp()
+        p = planet.PlanetUpdaterOsmosis(TESTFILE, osmosis_workdir=d)
+        p.get_timestamp = lambda: TESTFILE_TIMESTAMP
+        class Response(io.BytesIO):
+            def read(self, *args):
+                raise socket.timeout('test')
+        URLS = []
+        def u(url, timeout=None):
+            URLS.append(url)
+            return Response()
+        urlopen = planet.urlopen
+        planet.urlopen = u
+        retries = planet.STATE_RETRIES
+        planet.STATE_RETRIES = 2
+        try:
+            with self.assertRaises(socket.timeout):
+                p._initialize_state()
+        finally:
+            planet.urlopen = urlopen
+            planet.STATE_RETRIES = retries
+        self.assertEqual(len(URLS), 2)
+        self.assertEqual(os.listdir(d), [])
+        shutil.rmtree(d)
+
+    def update_planet(self, **kw):
+        d = tempfile.mkdtemp()
+        p = planet.PlanetUpdaterOsmosis(TESTFILE, osmosis_workdir=d, **kw)
+        with open(os.path.join(d, 'configuration.txt'), 'w') as f:
+            f.write('')
+        with open(os.path.join(d, 'state.txt'), 'w') as f:
+            f.write('')
+        COMMANDS = []
+        p.command = lambda x:COMMANDS.append(x)
+        p.update_planet('out.osm.pbf')
+        shutil.rmtree(d)
+        return d, COMMANDS
+
+    def test_update_planet_osmosis(self):
+        d, COMMANDS = self.update_planet()
+        self.assertEqual(len(COMMANDS), 1)
+        self.assertEqual(COMMANDS[0][:2], ['osmosis', '--read-replication-interval'])
+        self.assertIn('--apply-change', COMMANDS[0])
+
+    def test_update_planet_osmium(self):
+        d, COMMANDS = self.update_planet(apply_changes='osmium')
+        self.assertEqual(len(COMMANDS), 2)
+        self.assertEqual(COMMANDS[0][0], 'osmosis')
+        self.assertIn('--write-xml-change', COMMANDS[0])
+        self.assertEqual(COMMANDS[1][:3], ['osmium', 'apply-changes', '--overwrite'])
+        self.assertIn(os.path.join(d, 'changeset.osm.gz'), COMMANDS[1])
+
+class TestPlanetDownloaderS3(unittest.TestCase):
+    def test_download_planet_latest(self):
+        d = tempfile.mkdtemp()
+        outfile = os.path.join(d, 'test.osm.pbf')
+        p = planet.PlanetDownloaderS3(outfile)
+        PREFIXES = []
+        DOWNLOADS = []
+        def g(self, bucket, prefix, match):
+            PREFIXES.append(prefix)
+            if prefix is not None:
+                return iter([])
+            keys = ['2018/planet-180101.osm.pbf', '2018/planet-180108.osm.pbf', '2018/planet-180108.osm.pbf.md5']
+            return ({'Key': i} for i in keys if match.match(i))
+        def c(self, bucket_name, key, outpath):
+            DOWNLOADS.append([bucket_name, key, outpath])
+        p._get_planets = types.MethodType(g, p)
+        p._download = types.MethodType(c, p)
+        p.download_planet_latest()
+        self.assertEqual(len(PREFIXES), 3)
+        self.assertIsNone(PREFIXES[-1])
+        self.assertEqual(DOWNLOADS[0], ['osm-pds', '2018/planet-180108.osm.pbf', outfile + '.part'])
+        self.assertTrue(os.path.exists(outfile))
+        shutil.rmtree(d)
+
 if __name__ == '__main__':
     unittest.main()